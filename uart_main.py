@@ -6,6 +6,7 @@ from flask_socketio import SocketIO, emit
 from datetime import datetime
 import json
 import os
+import zlib
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -13,6 +14,12 @@ UART_PORT = '/dev/ttyUSB0'
 UART_BAUDRATE = 115200
 PACKET_SIZE = 64
 START_SEQ = bytes([0x01, 0x02, 0x03, 0x04])
+MAP_FILE_PATH = os.path.join(BASE_DIR, 'frontend/static/ignition_map.json')
+
+# Таймауты запуска (секунды)
+SYNC_RETRY_INTERVAL = 0.25
+SYNC_TIMEOUT = 5.0
+MAP_TRANSFER_TIMEOUT = 30.0
 
 # Команды
 CMD_WAIT_SYNC = 0x3A
@@ -75,6 +82,32 @@ def decode_xyz_payload(payload: bytes, command: int) -> tuple[int, float, int, f
     measured_zvs_voltage = struct.unpack('<f', payload[14:18])[0]
     return rpm, round(uoz, 2), delay_us, tps, round(measured_zvs_voltage, 2)
 
+def calc_map_hash(map_data: list[list[float]]) -> int:
+    # CRC32 по значениям карты в виде float32 little-endian, построчно —
+    # в том же виде, в каком карта хранится в ЭБУ
+    packed = b''.join(struct.pack('<f', v) for row in map_data for v in row)
+    return zlib.crc32(packed) & 0xFFFFFFFF
+
+def load_local_map() -> list[list[float]] | None:
+    try:
+        with open(MAP_FILE_PATH, 'r') as f:
+            map_data = json.load(f)
+    except Exception as e:
+        print(f"Failed to load ignition_map.json: {e}")
+        return None
+
+    # Кэш должен быть таблицей 32x32 из чисел, иначе считаем, что его нет
+    valid = (
+        isinstance(map_data, list) and len(map_data) == 32 and
+        all(isinstance(row, list) and len(row) == 32 and
+            all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in row)
+            for row in map_data)
+    )
+    if not valid:
+        print("Invalid ignition_map.json: expected 32x32 table of numbers")
+        return None
+    return map_data
+
 def build_uart_packet(command: int, payload_data: bytes = None) -> bytes:
     DATA_PAYLOAD = 55
     RESP_OK = 0x00
@@ -132,11 +165,10 @@ def complete_map_transfer():
     map_transfer_progress = {}
     
     # Сохраняем в файл в текущей директории
-    map_file_path = os.path.join(BASE_DIR, 'frontend/static/ignition_map.json')
-    with open(map_file_path, 'w') as f:
+    with open(MAP_FILE_PATH, 'w') as f:
         json.dump(ignition_map, f, indent=2)
     
-    print(f"Ignition map saved: 32x32 values at {map_file_path}")
+    print(f"Ignition map saved: 32x32 values at {MAP_FILE_PATH}")
     map_transfer_active = False
     connection_state = ConnectionState.READY_FOR_DATA
     
@@ -152,6 +184,9 @@ class UARTProtocol(asyncio.Protocol):
         self.connection_ready = asyncio.Event()
         self.waiting_for_packet = False
         self.expected_packet_start = None
+        # Ответ на синхронизацию: результат — хэш карты в ЭБУ (или None у старых прошивок)
+        self.sync_response = None
+        self.map_received = asyncio.Event()
 
     def connection_made(self, transport):
         global connection_state
@@ -215,8 +250,17 @@ class UARTProtocol(asyncio.Protocol):
 
             if self.expected_packet_start == START_SEQ:
                 if command == CMD_WAIT_SYNC:
-                    print("Sync response received")
-                    connection_state = ConnectionState.SYNC_COMPLETE
+                    # Ответы на повторные запросы синхронизации, пришедшие
+                    # после завершения синхронизации, игнорируем
+                    if self.sync_response is not None and not self.sync_response.done():
+                        ecu_map_hash = None
+                        if payload_len >= 4:
+                            ecu_map_hash = struct.unpack('<I', packet[7:11])[0]
+                        print(f"Sync response received, ECU map hash: {ecu_map_hash}")
+                        connection_state = ConnectionState.SYNC_COMPLETE
+                        self.sync_response.set_result(ecu_map_hash)
+                    else:
+                        print("Unexpected sync response ignored")
                     
                 elif command == CMD_GET_DATA:
                     if payload_len >= 18:
@@ -245,6 +289,7 @@ class UARTProtocol(asyncio.Protocol):
                 elif command == CMD_MAP_TRANSFER_COMPLETE:
                     print("Map transfer completed")
                     complete_map_transfer()
+                    self.map_received.set()
                 else:
                     print(f"Unknown command received: 0x{command:02X}")
 
@@ -301,12 +346,8 @@ async def send_ignition_map_over_uart(protocol: UARTProtocol):
     print("Sending ignition map over UART...")
     
     # Загружаем карту из файла
-    map_path = os.path.join(BASE_DIR, 'frontend/static/ignition_map.json')
-    try:
-        with open(map_path, 'r') as f:
-            ignition_map_local = json.load(f)
-    except Exception as e:
-        print(f"Failed to load ignition_map.json: {e}")
+    ignition_map_local = load_local_map()
+    if ignition_map_local is None:
         return
     
     # Поочерёдно отправляем данные строки порциями (до 13 значений на пакет)
@@ -368,56 +409,96 @@ def handle_get_map():
         print("Map update requested via WebSocket")
         emit('map_updated', {'map': ignition_map})
 
-async def protocol_handler(protocol: UARTProtocol):
+async def sync_with_ecu(protocol: UARTProtocol) -> int | None:
+    # Запрос синхронизации без данных; ЭБУ в ответе сообщает хэш своей карты,
+    # сравнение с локальным кэшем делает хост. Повторяем запрос, пока ЭБУ не ответит
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SYNC_TIMEOUT
+
+    while loop.time() < deadline:
+        protocol.sync_response = loop.create_future()
+        protocol.send(build_uart_packet(CMD_WAIT_SYNC))
+        try:
+            return await asyncio.wait_for(protocol.sync_response, SYNC_RETRY_INTERVAL)
+        except asyncio.TimeoutError:
+            continue
+        finally:
+            protocol.sync_response = None
+
+    print(f"Sync timeout after {SYNC_TIMEOUT} seconds")
+    return None
+
+async def transfer_ignition_map(protocol: UARTProtocol):
     global connection_state
-    await protocol.connection_ready.wait()
-    print("Starting protocol handler")
-    
-    # Шаг 1: Синхронизация
-    print("Step 1: Synchronization")
-    protocol.send(build_uart_packet(CMD_WAIT_SYNC))
-    
-    # Ждем синхронизации
-    timeout_count = 0
-    while connection_state != ConnectionState.SYNC_COMPLETE and timeout_count < 50:
-        await asyncio.sleep(0.1)
-        timeout_count += 1
-    
-    # Шаг 2: Запрос таблицы УОЗ
-    print("Step 2: Request ignition map")
+
+    print("Request ignition map")
     connection_state = ConnectionState.MAP_REQUESTED
+    protocol.map_received.clear()
     protocol.send(build_uart_packet(CMD_GET_IGNITION_MAP))
-    
-    # Ждем завершения передачи таблицы
-    print("Waiting for map transfer...")
-    timeout_count = 0
-    while connection_state != ConnectionState.READY_FOR_DATA and timeout_count < 300:
-        await asyncio.sleep(0.1)
-        timeout_count += 1
-        
-        if timeout_count % 20 == 0:
-            print(f"Still waiting for map transfer... {timeout_count/10} seconds")
-    
-    if connection_state != ConnectionState.READY_FOR_DATA:
-        print("Map transfer timeout after 30 seconds")
+
+    try:
+        await asyncio.wait_for(protocol.map_received.wait(), MAP_TRANSFER_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Map transfer timeout after {MAP_TRANSFER_TIMEOUT} seconds")
         return
-    
-    print('Богданчик')
+
+    # Загружаем полученную карту обратно в ЭБУ, чтобы в нём лежали те же
+    # округлённые значения, что и в локальном кэше — тогда хэши совпадут
+    # при следующем подключении
     await send_ignition_map_over_uart(protocol)
 
-    # Шаг 3: Циклический опрос данных
-    print("Step 3: Start data polling")
+def log_map_task_result(task: asyncio.Task):
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        print(f"Map transfer failed: {e!r}")
+
+async def poll_live_data(protocol: UARTProtocol):
+    print("Start data polling")
     data_request_count = 0
-    
+
     while True:
         protocol.send(build_uart_packet(CMD_GET_DATA))
         data_request_count += 1
-        
+
         if data_request_count % 10 == 0:
             print(f"Data polling: {data_request_count} requests sent")
-            
+
         await asyncio.sleep(0.1)
 
+async def protocol_handler(protocol: UARTProtocol):
+    global connection_state, ignition_map
+    await protocol.connection_ready.wait()
+    print("Starting protocol handler")
+
+    cached_map = load_local_map()
+    local_hash = calc_map_hash(cached_map) if cached_map is not None else None
+
+    # Шаг 1: Синхронизация, ЭБУ сообщает хэш своей карты
+    print("Step 1: Synchronization")
+    ecu_hash = await sync_with_ecu(protocol)
+
+    # Шаг 2: Карта УОЗ — пропускаем передачу, если карта в ЭБУ совпадает с кэшем
+    map_task = None
+    if local_hash is not None and ecu_hash == local_hash:
+        print("Step 2: ECU map matches cached map, skipping transfer")
+        ignition_map = cached_map
+        connection_state = ConnectionState.READY_FOR_DATA
+        socketio.emit('map_updated', {'map': ignition_map})
+    else:
+        print("Step 2: ECU map differs from cached map, transferring in background")
+        map_task = asyncio.create_task(transfer_ignition_map(protocol))
+        map_task.add_done_callback(log_map_task_result)
+
+    # Шаг 3: Циклический опрос данных параллельно с передачей карты
+    print("Step 3: Start data polling")
+    try:
+        await poll_live_data(protocol)
+    finally:
+        if map_task is not None:
+            map_task.cancel()
+
 async def run_uart_tasks():
     protocol = await uart_reader()
     await protocol_handler(protocol)